@@ -1,11 +1,19 @@
 import streamlit as st
 import sqlite3
 import hashlib
+import hmac
 import datetime
 import base64
 import os
-from typing import List
-from openai import OpenAI
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List, Tuple
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # -------------------- CONFIG --------------------
 st.set_page_config(
@@ -13,17 +21,52 @@ st.set_page_config(
     layout="wide"
 )
 
-client = OpenAI()  # uses OPENAI_API_KEY from environment
+# Whitespace that follows a sentence-ending ".", "!" or "?".
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+
+# Rows per page on dashboard lists.
+PAGE_SIZE = 50
+
+# Lesson illustrations are stored here as PNG files; SQLite keeps only the path.
+IMAGE_DIR = "images"
 
 # -------------------- DB HELPERS --------------------
+@st.cache_resource
 def get_connection():
-    conn = sqlite3.connect("learning_app.db", check_same_thread=False)
+    """
+    Single shared connection for every rerun and session.
+    Streamlit re-executes this script on each interaction, so the
+    connection (and schema setup) must live in the resource cache.
+    """
+    conn = sqlite3.connect("learning_app.db", check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    # WAL + NORMAL sync keeps commits cheap and lets readers run during writes.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA busy_timeout=5000")
+    init_db(conn)
     return conn
 
-conn = get_connection()
+@st.cache_resource
+def get_write_lock():
+    return threading.Lock()
+
+@contextmanager
+def write_transaction():
+    """
+    Run a write on the shared connection. Every session's thread uses the
+    same connection, so the lock stops one session from committing (or
+    starting a transaction inside) another's half-done write; `with conn`
+    commits on success and rolls back on error.
+    """
+    conn = get_connection()
+    with get_write_lock(), conn:
+        yield conn
 
-def init_db():
+def init_db(conn):
     cur = conn.cursor()
 
     cur.execute("""
@@ -32,7 +75,8 @@ def init_db():
         name TEXT NOT NULL,
         email TEXT UNIQUE NOT NULL,
         password_hash TEXT NOT NULL,
-        role TEXT NOT NULL
+        role TEXT NOT NULL,
+        session_nonce TEXT
     )
     """)
 
@@ -58,7 +102,8 @@ def init_db():
         title TEXT,
         original_text TEXT,
         friendly_text TEXT,
-        image_b64 TEXT,
+        image_path TEXT,
+        total_steps INTEGER,
         created_at TEXT
     )
     """)
@@ -85,29 +130,291 @@ def init_db():
     )
     """)
 
+    migrate_lesson_images(conn)
+    migrate_lesson_steps(conn)
+    migrate_session_nonce(conn)
+
+    # users.email is already covered by its UNIQUE constraint.
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_la_learner_id ON lesson_assignments(learner_id, id DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_hr_to_user ON help_requests(to_user_id, created_at DESC)")
+
+    # One row per link. Clear out duplicates left by repeated "Add" clicks
+    # before the unique index goes on; its leading column also serves
+    # lookups by teacher/parent, so the plain indexes are dropped.
+    cur.execute("""
+    DELETE FROM teacher_learners WHERE rowid NOT IN (
+        SELECT MIN(rowid) FROM teacher_learners GROUP BY teacher_id, learner_id
+    )
+    """)
+    cur.execute("""
+    DELETE FROM parent_children WHERE rowid NOT IN (
+        SELECT MIN(rowid) FROM parent_children GROUP BY parent_id, learner_id
+    )
+    """)
+    cur.execute("DROP INDEX IF EXISTS idx_tl_teacher")
+    cur.execute("DROP INDEX IF EXISTS idx_pc_parent")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_tl_uniq ON teacher_learners(teacher_id, learner_id)")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_pc_uniq ON parent_children(parent_id, learner_id)")
+
+    # Full-text index over users(name, email) for learner search, kept in
+    # sync by triggers and built from existing rows the first time.
+    fts_exists = cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_fts'"
+    ).fetchone()
+    cur.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS users_fts
+    USING fts5(name, email, content='users', content_rowid='id')
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts (rowid, name, email) VALUES (new.id, new.name, new.email);
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, name, email) VALUES ('delete', old.id, old.name, old.email);
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF name, email ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, name, email) VALUES ('delete', old.id, old.name, old.email);
+        INSERT INTO users_fts (rowid, name, email) VALUES (new.id, new.name, new.email);
+    END
+    """)
+    if not fts_exists:
+        cur.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+    conn.commit()
+
+def table_columns(conn, table: str) -> List[str]:
+    return [r["name"] for r in conn.execute(f"PRAGMA table_info({table})")]
+
+def migrate_lesson_images(conn):
+    """
+    One-time move of base64 images stored in lessons.image_b64
+    (older databases) to PNG files referenced by lessons.image_path.
+    """
+    columns = table_columns(conn, "lessons")
+    if "image_path" not in columns:
+        conn.execute("ALTER TABLE lessons ADD COLUMN image_path TEXT")
+    if "image_b64" not in columns:
+        return
+
+    rows = conn.execute("""
+    SELECT id, image_b64 FROM lessons
+    WHERE image_b64 IS NOT NULL AND image_b64 != '' AND image_path IS NULL
+    """).fetchall()
+    for r in rows:
+        conn.execute(
+            "UPDATE lessons SET image_path = ?, image_b64 = NULL WHERE id = ?",
+            (save_lesson_image(r["image_b64"]), r["id"])
+        )
+    conn.commit()
+
+def migrate_lesson_steps(conn):
+    """
+    Add lessons.total_steps to older databases and fill it for existing rows.
+    """
+    if "total_steps" not in table_columns(conn, "lessons"):
+        conn.execute("ALTER TABLE lessons ADD COLUMN total_steps INTEGER")
+
+    rows = conn.execute(
+        "SELECT id, friendly_text FROM lessons WHERE total_steps IS NULL"
+    ).fetchall()
+    conn.executemany(
+        "UPDATE lessons SET total_steps = ? WHERE id = ?",
+        [(len(lesson_steps(r["friendly_text"] or "")), r["id"]) for r in rows]
+    )
     conn.commit()
 
-init_db()
+def migrate_session_nonce(conn):
+    """
+    Add users.session_nonce to older databases and give every user one.
+    Changing a user's nonce invalidates all of their session tokens.
+    """
+    if "session_nonce" not in table_columns(conn, "users"):
+        conn.execute("ALTER TABLE users ADD COLUMN session_nonce TEXT")
+    conn.execute(
+        "UPDATE users SET session_nonce = lower(hex(randomblob(16))) WHERE session_nonce IS NULL"
+    )
+    conn.commit()
 
 # -------------------- BASIC UTILS --------------------
+# Stored as "scrypt$" + base64(salt + key). Hashes without the prefix are
+# legacy unsalted SHA-256 digests and get upgraded on the next login.
+SCRYPT_PREFIX = "scrypt$"
+
+def scrypt_key(pw: str, salt: bytes) -> bytes:
+    return hashlib.scrypt(pw.encode("utf-8"), salt=salt, n=2**14, r=8, p=1, dklen=32)
+
 def hash_password(pw: str) -> str:
-    return hashlib.sha256(pw.encode("utf-8")).hexdigest()
+    salt = os.urandom(16)
+    return SCRYPT_PREFIX + base64.b64encode(salt + scrypt_key(pw, salt)).decode("ascii")
 
 def check_password(pw: str, hashed: str) -> bool:
-    return hash_password(pw) == hashed
+    if needs_rehash(hashed):
+        legacy = hashlib.sha256(pw.encode("utf-8")).hexdigest()
+        return hmac.compare_digest(legacy, hashed)
+    raw = base64.b64decode(hashed[len(SCRYPT_PREFIX):])
+    salt, key = raw[:16], raw[16:]
+    return hmac.compare_digest(scrypt_key(pw, salt), key)
+
+def needs_rehash(hashed: str) -> bool:
+    return not hashed.startswith(SCRYPT_PREFIX)
+
+@st.cache_resource
+def session_secret() -> bytes:
+    """
+    Key for signing session tokens. Set SESSION_SECRET to keep tokens valid
+    across restarts; otherwise a random key lives as long as the process.
+    """
+    secret = os.environ.get("SESSION_SECRET")
+    return secret.encode("utf-8") if secret else os.urandom(32)
+
+# "<id>.<expires>.<hmac>"; anything else in ?s= is treated as no session.
+SESSION_TOKEN_RE = re.compile(r"(\d{1,18})\.(\d{1,12})\.([0-9a-f]{32})", re.ASCII)
+
+# How long a token in the URL stays valid. A live session gets a fresh one
+# from the DB once its token runs out.
+SESSION_TTL_SECONDS = 12 * 60 * 60
+
+def new_session_nonce() -> str:
+    return os.urandom(16).hex()
+
+def session_signature(user: dict, expires: int) -> str:
+    """
+    HMAC over id, expiry, role, name and the user's session nonce, so a
+    token dies when it expires or when logout rotates the nonce.
+    """
+    msg = f"{user['id']}:{expires}:{user['role']}:{user['name']}:{user['session_nonce']}"
+    return hmac.new(session_secret(), msg.encode("utf-8"), "sha256").hexdigest()[:32]
+
+def session_token(user: dict) -> str:
+    """Signed token kept in the URL as ?s=..."""
+    expires = int(time.time()) + SESSION_TTL_SECONDS
+    return f"{user['id']}.{expires}.{session_signature(user, expires)}"
+
+def parse_session_token(token):
+    """(user id, expires, signature) from a well-formed token, or None."""
+    m = SESSION_TOKEN_RE.fullmatch(token or "")
+    if m is None:
+        return None
+    return int(m.group(1)), int(m.group(2)), m.group(3)
+
+def session_token_valid(token, user: dict) -> bool:
+    parsed = parse_session_token(token)
+    if parsed is None:
+        return False
+    uid, expires, sig = parsed
+    if uid != user["id"] or expires < time.time():
+        return False
+    return hmac.compare_digest(sig.encode("ascii"), session_signature(user, expires).encode("ascii"))
+
+def save_lesson_image(b64_data: str) -> str:
+    """
+    Decode a base64 PNG into a new, uniquely named file in IMAGE_DIR and
+    return its path. Each preview owns its file, so discarding one can't
+    remove an image another author is still looking at.
+    """
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    path = os.path.join(IMAGE_DIR, f"{uuid.uuid4().hex}.png")
+    with open(path, "wb") as f:
+        f.write(base64.b64decode(b64_data))
+    return path
+
+def utc_now_iso() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+def lesson_steps(friendly_text: str) -> List[str]:
+    """One step per non-empty line of the friendly lesson text."""
+    return [s for s in friendly_text.split("\n") if s.strip()]
+
+def fts_prefix_query(text: str) -> str:
+    """
+    Turn free text into an FTS5 query where every word must match the
+    start of a word in the name or email. Words are quoted, so characters
+    like '@' or '-' are never read as query syntax.
+    """
+    return " ".join('"' + w.replace('"', '""') + '"*' for w in text.split())
 
 def split_into_steps(text: str, sentences_per_step: int = 1) -> List[str]:
-    sentences = [s.strip() for s in text.replace("\n", " ").split(".") if s.strip()]
-    steps = []
-    for i in range(0, len(sentences), sentences_per_step):
-        part = ". ".join(sentences[i:i + sentences_per_step]).strip()
-        if part and not part.endswith("."):
-            part += "."
-        if part:
-            steps.append(part)
-    return steps
+    sentences = [" ".join(s.split()) for s in SENTENCE_END_RE.split(text) if s.strip()]
+    # Only the final sentence can lack closing punctuation after the split.
+    if sentences and not sentences[-1].endswith((".", "!", "?")):
+        sentences[-1] += "."
+    return [
+        " ".join(sentences[i:i + sentences_per_step])
+        for i in range(0, len(sentences), sentences_per_step)
+    ]
 
 # -------------------- OPENAI HELPERS --------------------
+# The openai package is imported on first use rather than at the top of the
+# file: it is the slowest import here, and login, sign-up and the learner
+# dashboard never need it.
+
+def is_transient_openai_error(exc: BaseException) -> bool:
+    """
+    Rate limits, timeouts, dropped connections and 5xx are worth another try;
+    anything else (bad key, bad request) fails straight away.
+    """
+    import openai
+    return isinstance(exc, (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    ))
+
+openai_retry = retry(
+    wait=wait_random_exponential(min=1, max=20),
+    stop=stop_after_attempt(3),
+    retry=retry_if_exception(is_transient_openai_error),
+    reraise=True,
+)
+
+# Built once per process; module-level code re-runs on every interaction,
+# including the login and sign-up pages that never call OpenAI.
+@st.cache_resource
+def get_openai_client():
+    from openai import OpenAI
+    return OpenAI(max_retries=0)  # uses OPENAI_API_KEY from environment; retries via openai_retry
+
+@openai_retry
+def create_chat_completion(**kwargs):
+    return get_openai_client().chat.completions.create(**kwargs)
+
+@openai_retry
+def create_image(**kwargs):
+    return get_openai_client().images.generate(**kwargs)
+
+# Results are memoized on the prompt, so pressing "Generate" again for the
+# same text is free. Failures raise and are therefore never cached.
+@st.cache_data(show_spinner=False, ttl=86400)
+def complete_friendly_text(system_msg: str, user_msg: str) -> str:
+    completion = create_chat_completion(
+        model="gpt-4.1-mini",
+        messages=[
+            {"role": "system", "content": system_msg},
+            {"role": "user", "content": user_msg},
+        ],
+        temperature=0.4,
+    )
+    return completion.choices[0].message.content.strip()
+
+# source_digest (sha256 of the lesson text) is only part of the cache key:
+# the prompt is built from the title alone, and without it every lesson
+# with the same title, from any author, would share one picture.
+@st.cache_data(show_spinner=False, ttl=86400)
+def draw_lesson_image(prompt: str, source_digest: str, quality: str = "auto") -> str:
+    img = create_image(
+        model="gpt-image-1",
+        prompt=prompt,
+        size="1024x1024",
+        quality=quality,
+        n=1
+    )
+    return img.data[0].b64_json
+
 def generate_friendly_text_with_openai(original: str, mode: str = "chapter") -> str:
     """
     Use OpenAI to turn a long chapter/story into
@@ -137,16 +444,7 @@ def generate_friendly_text_with_openai(original: str, mode: str = "chapter") ->
     )
 
     try:
-        completion = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[
-                {"role": "system", "content": system_msg},
-                {"role": "user", "content": user_msg},
-            ],
-            temperature=0.4,
-        )
-        text = completion.choices[0].message.content.strip()
-        return text
+        return complete_friendly_text(system_msg, user_msg)
     except Exception as e:
         st.error(f"AI text generation error: {e}")
         # Fallback: simple local step-split
@@ -154,10 +452,11 @@ def generate_friendly_text_with_openai(original: str, mode: str = "chapter") ->
             [f"Step {i+1}: {s}" for i, s in enumerate(split_into_steps(original, 2))]
         )
 
-def generate_lesson_image_b64(title: str, original: str) -> str:
+def generate_lesson_image(title: str, original: str, final: bool = False) -> str:
     """
     Use OpenAI image model to generate a simple illustration for the lesson.
-    Returns base64 string for storage.
+    Drawn at low quality unless final=True, which the author asks for from
+    the preview before saving. Returns the path of the saved PNG ("" on failure).
     """
     prompt = (
         "Create a simple, friendly, colorful illustration for a children's lesson titled "
@@ -165,90 +464,248 @@ def generate_lesson_image_b64(title: str, original: str) -> str:
         "Avoid text in the image. The style should be soft and inviting."
     )
     try:
-        img = client.images.generate(
-            model="gpt-image-1",
-            prompt=prompt,
-            size="1024x1024",
-            n=1
-        )
-        b64_data = img.data[0].b64_json
-        return b64_data
+        quality = "auto" if final else "low"
+        source_digest = hashlib.sha256(original.encode("utf-8")).hexdigest()
+        return save_lesson_image(draw_lesson_image(prompt, source_digest, quality))
     except Exception as e:
         st.error(f"AI image generation error: {e}")
         return ""
 
-def display_b64_image(b64_data: str, caption: str = ""):
-    if not b64_data:
+def generate_lesson_with_ai(title: str, original: str, mode: str = "chapter") -> Tuple[str, str]:
+    """
+    Run the text and image requests side by side; they are independent,
+    so the wait is the slower of the two instead of their sum.
+    Returns (friendly_text, image_path).
+    """
+    # Worker threads need the script context so st.error() still reaches the page.
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx, initargs=(None, ctx)) as ex:
+        fut_text = ex.submit(generate_friendly_text_with_openai, original, mode)
+        fut_img = ex.submit(generate_lesson_image, title or "Lesson", original)
+        return fut_text.result(), fut_img.result()
+
+def page_offset(key: str) -> int:
+    return (st.session_state.get(key, 1) - 1) * PAGE_SIZE
+
+def split_page(rows) -> Tuple[list, bool]:
+    """
+    List queries fetch PAGE_SIZE + 1 rows; the extra one only says whether
+    a next page exists. Returns (rows for this page, has_more).
+    """
+    return rows[:PAGE_SIZE], len(rows) > PAGE_SIZE
+
+def page_picker(key: str, has_more: bool):
+    """Show the page selector once a list has more than one page."""
+    page = st.session_state.get(key, 1)
+    if has_more or page > 1:
+        st.number_input("Page", min_value=1, max_value=page + 1 if has_more else page, step=1, key=key)
+
+def empty_page_message(key: str, message: str) -> str:
+    """message for an empty list, unless we're just past its last page."""
+    return "No more items on this page." if page_offset(key) > 0 else message
+
+def display_lesson_image(image_path: str, caption: str = ""):
+    if not image_path:
         return
     try:
-        img_bytes = base64.b64decode(b64_data)
-        st.image(img_bytes, caption=caption, use_column_width=True)
+        st.image(image_path, caption=caption, use_column_width=True)
     except Exception as e:
         st.error(f"Error displaying image: {e}")
 
+# -------------------- SQL --------------------
+# Runtime statements live in module-level constants so each one is always
+# the same string and hits sqlite3's per-connection statement cache.
+SQL_USER_BY_EMAIL = "SELECT id, name, email, password_hash, role, session_nonce FROM users WHERE email = ?"
+SQL_USER_BY_ID = "SELECT id, name, email, role, session_nonce FROM users WHERE id = ?"
+
+SQL_SEARCH_LEARNERS = """
+SELECT u.id, u.name, u.email FROM users u
+JOIN users_fts f ON u.id = f.rowid
+WHERE users_fts MATCH ? AND u.role = 'learner'
+ORDER BY u.name
+"""
+
+SQL_TEACHER_LEARNERS = """
+SELECT u.id, u.name, u.email FROM users u
+JOIN teacher_learners tl ON u.id = tl.learner_id
+WHERE tl.teacher_id = ?
+ORDER BY u.name
+"""
+
+SQL_PARENT_CHILDREN = """
+SELECT u.id, u.name, u.email FROM users u
+JOIN parent_children pc ON u.id = pc.learner_id
+WHERE pc.parent_id = ?
+ORDER BY u.name
+"""
+
+SQL_ASSIGNED_LESSONS = """
+SELECT la.id, la.lesson_id, la.status, la.progress_step,
+       l.title, l.total_steps, u.name as owner_name, l.owner_role
+FROM lesson_assignments la
+JOIN lessons l ON la.lesson_id = l.id
+JOIN users u ON l.owner_id = u.id
+WHERE la.learner_id = ?
+ORDER BY la.id DESC
+LIMIT ? OFFSET ?
+"""
+
+# {placeholder} is filled with one "?" per learner id.
+SQL_LESSON_PROGRESS = """
+SELECT la.id, la.status, la.progress_step, l.title, u.name as learner_name
+FROM lesson_assignments la
+JOIN lessons l ON la.lesson_id = l.id
+JOIN users u ON la.learner_id = u.id
+WHERE la.learner_id IN ({placeholder})
+ORDER BY la.id DESC
+LIMIT ? OFFSET ?
+"""
+
+SQL_HELP_REQUESTS = """
+SELECT hr.id, hr.message, hr.created_at, hr.resolved, u.name as learner_name
+FROM help_requests hr
+JOIN users u ON hr.learner_id = u.id
+WHERE hr.to_user_id = ?
+ORDER BY hr.created_at DESC
+LIMIT ? OFFSET ?
+"""
+
+SQL_LESSON_BODY = "SELECT friendly_text, image_path FROM lessons WHERE id = ?"
+
+SQL_IMAGE_IN_USE = "SELECT 1 FROM lessons WHERE image_path = ? LIMIT 1"
+
+SQL_LINKED_GROWNUPS = """
+SELECT DISTINCT u.id, u.name, u.role FROM users u
+LEFT JOIN teacher_learners tl ON (u.id = tl.teacher_id AND tl.learner_id = ?)
+LEFT JOIN parent_children pc ON (u.id = pc.parent_id AND pc.learner_id = ?)
+WHERE (tl.learner_id IS NOT NULL OR pc.learner_id IS NOT NULL)
+"""
+
+SQL_INSERT_USER = "INSERT INTO users (name, email, password_hash, role, session_nonce) VALUES (?, ?, ?, ?, ?)"
+SQL_UPDATE_PASSWORD_HASH = "UPDATE users SET password_hash = ? WHERE id = ?"
+SQL_UPDATE_SESSION_NONCE = "UPDATE users SET session_nonce = ? WHERE id = ?"
+SQL_ADD_TEACHER_LEARNER = "INSERT OR IGNORE INTO teacher_learners (teacher_id, learner_id) VALUES (?, ?)"
+SQL_ADD_PARENT_CHILD = "INSERT OR IGNORE INTO parent_children (parent_id, learner_id) VALUES (?, ?)"
+
+SQL_INSERT_LESSON = """
+INSERT INTO lessons (owner_id, owner_role, title, original_text, friendly_text, image_path, total_steps, created_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SQL_INSERT_ASSIGNMENT = """
+INSERT INTO lesson_assignments (lesson_id, learner_id, status, progress_step, completed_at)
+VALUES (?, ?, ?, ?, ?)
+"""
+
+SQL_UPDATE_PROGRESS_STEP = "UPDATE lesson_assignments SET progress_step = ? WHERE id = ?"
+
+SQL_COMPLETE_ASSIGNMENT = """
+UPDATE lesson_assignments
+SET status = 'completed', progress_step = ?, completed_at = ?
+WHERE id = ?
+"""
+
+SQL_INSERT_HELP_REQUEST = """
+INSERT INTO help_requests (learner_id, to_user_id, message, created_at, resolved)
+VALUES (?, ?, ?, ?, 0)
+"""
+
+SQL_RESOLVE_HELP_REQUEST = "UPDATE help_requests SET resolved = 1 WHERE id = ?"
+
 # -------------------- DB QUERIES --------------------
+# User lookups are cached as plain dicts: sqlite3.Row can't be pickled
+# by st.cache_data, and these run on nearly every rerun.
+@st.cache_data(ttl=60)
 def get_user_by_email(email: str):
+    conn = get_connection()
     cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE email = ?", (email,))
-    return cur.fetchone()
-
-def get_user_by_id(uid: int):
+    cur.execute(SQL_USER_BY_EMAIL, (email,))
+    row = cur.fetchone()
+    return dict(row) if row is not None else None
+
+# The user row plus the people linked to them (a teacher's learners, a
+# parent's children, a learner's grown-ups) in one cached call, shared by
+# the session check and every dashboard tab. Cleared when a link is added.
+@st.cache_data(ttl=10, show_spinner=False)
+def get_user_bundle(uid: int):
+    conn = get_connection()
     cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE id = ?", (uid,))
-    return cur.fetchone()
+    cur.execute(SQL_USER_BY_ID, (uid,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    user = dict(row)
+    if user["role"] == "teacher":
+        cur.execute(SQL_TEACHER_LEARNERS, (uid,))
+    elif user["role"] == "parent":
+        cur.execute(SQL_PARENT_CHILDREN, (uid,))
+    else:
+        cur.execute(SQL_LINKED_GROWNUPS, (uid, uid))
+    return {"user": user, "linked": [dict(r) for r in cur.fetchall()]}
+
+def get_linked_users(uid: int):
+    bundle = get_user_bundle(uid)
+    return bundle["linked"] if bundle is not None else []
 
 def search_learners(query: str):
+    match = fts_prefix_query(query)
+    if not match:
+        return []
+    conn = get_connection()
     cur = conn.cursor()
-    like = f"%{query}%"
-    cur.execute("""
-    SELECT * FROM users
-    WHERE role = 'learner' AND (name LIKE ? OR email LIKE ?)
-    ORDER BY name
-    """, (like, like))
+    cur.execute(SQL_SEARCH_LEARNERS, (match,))
     return cur.fetchall()
 
-def get_teacher_learners(teacher_id: int):
+def list_assigned_lessons(learner_id: int, offset: int = 0):
+    """
+    Lightweight lesson list for the learner dashboard; the lesson body is
+    fetched separately by load_lesson_body().
+    """
+    conn = get_connection()
     cur = conn.cursor()
-    cur.execute("""
-    SELECT u.* FROM users u
-    JOIN teacher_learners tl ON u.id = tl.learner_id
-    WHERE tl.teacher_id = ?
-    ORDER BY u.name
-    """, (teacher_id,))
-    return cur.fetchall()
+    cur.execute(SQL_ASSIGNED_LESSONS, (learner_id, PAGE_SIZE + 1, offset))
+    return split_page(cur.fetchall())
 
-def get_parent_children(parent_id: int):
+def get_lesson_progress(learner_ids, offset: int = 0):
+    conn = get_connection()
     cur = conn.cursor()
-    cur.execute("""
-    SELECT u.* FROM users u
-    JOIN parent_children pc ON u.id = pc.learner_id
-    WHERE pc.parent_id = ?
-    ORDER BY u.name
-    """, (parent_id,))
-    return cur.fetchall()
+    placeholder = ",".join("?" * len(learner_ids))
+    cur.execute(
+        SQL_LESSON_PROGRESS.format(placeholder=placeholder),
+        (*learner_ids, PAGE_SIZE + 1, offset)
+    )
+    return split_page(cur.fetchall())
 
-def get_assigned_lessons(learner_id: int):
+def get_help_requests(to_user_id: int, offset: int = 0):
+    conn = get_connection()
     cur = conn.cursor()
-    cur.execute("""
-    SELECT la.*, l.title, l.friendly_text, l.original_text, l.image_b64,
-           u.name as owner_name, l.owner_role
-    FROM lesson_assignments la
-    JOIN lessons l ON la.lesson_id = l.id
-    JOIN users u ON l.owner_id = u.id
-    WHERE la.learner_id = ?
-    ORDER BY la.id DESC
-    """, (learner_id,))
-    return cur.fetchall()
-
-def get_linked_grownups_for_learner(learner_id: int):
+    cur.execute(SQL_HELP_REQUESTS, (to_user_id, PAGE_SIZE + 1, offset))
+    return split_page(cur.fetchall())
+
+# Lessons are never edited after saving, so their bodies (already split
+# into steps) can stay cached.
+@st.cache_data(show_spinner=False)
+def load_lesson_body(lesson_id: int):
+    conn = get_connection()
     cur = conn.cursor()
-    cur.execute("""
-    SELECT DISTINCT u.* FROM users u
-    LEFT JOIN teacher_learners tl ON (u.id = tl.teacher_id AND tl.learner_id = ?)
-    LEFT JOIN parent_children pc ON (u.id = pc.parent_id AND pc.learner_id = ?)
-    WHERE (tl.learner_id IS NOT NULL OR pc.learner_id IS NOT NULL)
-    """, (learner_id, learner_id))
-    return cur.fetchall()
+    cur.execute(SQL_LESSON_BODY, (lesson_id,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return {"steps": lesson_steps(row["friendly_text"]), "image_path": row["image_path"]}
+
+def discard_lesson_image(image_path: str):
+    """
+    Delete a preview image that has been replaced, unless it was already
+    saved with a lesson (the form keeps showing it after "Save").
+    Holds the write lock so a concurrent save can't claim it mid-delete.
+    """
+    if not image_path:
+        return
+    with get_write_lock():
+        in_use = get_connection().execute(SQL_IMAGE_IN_USE, (image_path,)).fetchone()
+        if in_use is None and os.path.exists(image_path):
+            os.remove(image_path)
 
 # -------------------- AUTH UI --------------------
 def signup_form():
@@ -260,37 +717,42 @@ def signup_form():
         horizontal=True
     )
 
-    if role == "learner":
-        st.markdown(
-            """
-            ### 🌈 Welcome!
-            This space is for calm, step-by-step learning.
-            You can fill this in with a grown-up if you like.
-            """
-        )
-        col1, col2 = st.columns(2)
-        with col1:
-            name = st.text_input("Your first name")
-        with col2:
-            feeling = st.slider("How ready do you feel?", 1, 5, 3)
-            st.caption("1 = a bit tired, 5 = very ready!")
+    # Fields only reach the script when the form is submitted, not on every
+    # keystroke. The role picker stays outside so its fields can change.
+    with st.form("signup"):
+        if role == "learner":
+            st.markdown(
+                """
+                ### 🌈 Welcome!
+                This space is for calm, step-by-step learning.
+                You can fill this in with a grown-up if you like.
+                """
+            )
+            col1, col2 = st.columns(2)
+            with col1:
+                name = st.text_input("Your first name")
+            with col2:
+                feeling = st.slider("How ready do you feel?", 1, 5, 3)
+                st.caption("1 = a bit tired, 5 = very ready!")
 
-        email = st.text_input("Email (yours or a grown-up's)")
-        password = st.text_input("Choose a password", type="password")
-        password2 = st.text_input("Repeat password", type="password")
+            email = st.text_input("Email (yours or a grown-up's)")
+            password = st.text_input("Choose a password", type="password")
+            password2 = st.text_input("Repeat password", type="password")
 
-    else:
-        if role == "teacher":
-            st.markdown("### 🧑‍🏫 Teacher sign-up")
         else:
-            st.markdown("### 👨‍👩‍👧 Parent sign-up")
+            if role == "teacher":
+                st.markdown("### 🧑‍🏫 Teacher sign-up")
+            else:
+                st.markdown("### 👨‍👩‍👧 Parent sign-up")
 
-        name = st.text_input("Full name")
-        email = st.text_input("Email")
-        password = st.text_input("Password", type="password")
-        password2 = st.text_input("Repeat password", type="password")
+            name = st.text_input("Full name")
+            email = st.text_input("Email")
+            password = st.text_input("Password", type="password")
+            password2 = st.text_input("Repeat password", type="password")
 
-    if st.button("Sign up", use_container_width=True):
+        submitted = st.form_submit_button("Sign up", use_container_width=True)
+
+    if submitted:
         if not name or not email or not password:
             st.error("Please fill in all required fields.")
             return
@@ -303,21 +765,20 @@ def signup_form():
             st.error("An account with this email already exists.")
             return
 
-        cur = conn.cursor()
-        cur.execute("""
-        INSERT INTO users (name, email, password_hash, role)
-        VALUES (?, ?, ?, ?)
-        """, (name, email, hash_password(password), role))
-        conn.commit()
+        with write_transaction() as conn:
+            conn.execute(SQL_INSERT_USER, (name, email, hash_password(password), role, new_session_nonce()))
+        get_user_by_email.clear()
         st.success("Account created! You can log in now.")
 
 def login_form():
     st.subheader("Log in")
 
-    email = st.text_input("Email", key="login_email")
-    password = st.text_input("Password", type="password", key="login_pw")
+    with st.form("login"):
+        email = st.text_input("Email", key="login_email")
+        password = st.text_input("Password", type="password", key="login_pw")
+        submitted = st.form_submit_button("Log in", use_container_width=True)
 
-    if st.button("Log in", use_container_width=True):
+    if submitted:
         user = get_user_by_email(email)
         if user is None:
             st.error("No account found with that email.")
@@ -327,11 +788,167 @@ def login_form():
             st.error("Incorrect password.")
             return
 
-        st.session_state.user_id = user["id"]
-        st.session_state.user_role = user["role"]
-        st.session_state.user_name = user["name"]
+        if needs_rehash(user["password_hash"]):
+            with write_transaction() as conn:
+                conn.execute(SQL_UPDATE_PASSWORD_HASH, (hash_password(password), user["id"]))
+            get_user_by_email.clear()
+
+        start_session({k: v for k, v in user.items() if k != "password_hash"})
         st.rerun()
 
+# All auth state is one dict under st.session_state["auth"]: the user's
+# id, name, email and role, or absent when logged out.
+def start_session(user: dict):
+    st.session_state["auth"] = user
+    st.query_params["s"] = session_token(user)
+    st.query_params.pop("tab", None)
+
+def restore_session():
+    """
+    Return the logged-in user. A session whose URL token still matches only
+    has its nonce checked against the cached user bundle (at most 10 s old),
+    so a logout anywhere ends it; otherwise the user is re-read by id,
+    which also lets a bookmarked ?s= link log straight back in.
+    """
+    token = st.query_params.get("s")
+    auth = st.session_state.get("auth")
+    if auth is not None and session_token_valid(token, auth):
+        bundle = get_user_bundle(auth["id"])
+        if bundle is None or bundle["user"]["session_nonce"] != auth.get("session_nonce"):
+            return None  # user gone, or logged out elsewhere
+        return auth
+
+    if auth is not None:
+        uid = auth["id"]
+    else:
+        parsed = parse_session_token(token)
+        if parsed is None:
+            return None
+        uid = parsed[0]
+
+    bundle = get_user_bundle(uid)
+    if bundle is None:
+        return None
+    user = bundle["user"]
+    if auth is None and not session_token_valid(token, user):
+        return None
+    if auth is not None and auth.get("session_nonce") != user["session_nonce"]:
+        return None  # logged out elsewhere
+    start_session(user)
+    return user
+
+# -------------------- CREATE LESSON (TEACHER & PARENT) --------------------
+# Wording that differs between the teacher and parent "Create lesson" tabs.
+CREATE_LESSON_COPY = {
+    "teacher": {
+        "assign_label": "Assign to learners",
+        "save_label": "Save & assign lesson",
+        "missing_msg": "Please provide title, text, and generated lesson.",
+        "saved_msg": "Lesson created and assigned!",
+    },
+    "parent": {
+        "assign_label": "Send to:",
+        "save_label": "Save & send",
+        "missing_msg": "Please fill all fields.",
+        "saved_msg": "Lesson created and sent!",
+    },
+}
+
+def render_create_lesson(owner_role: str, owner_id: int, audience_map: dict, key_prefix: str):
+    """
+    Shared "Create lesson" form. audience_map maps display labels to
+    learner ids; key_prefix keeps each dashboard's widget state separate.
+    """
+    copy = CREATE_LESSON_COPY[owner_role]
+
+    colA, colB = st.columns([2, 1])
+    with colA:
+        title = st.text_input("Lesson title", key=f"{key_prefix}_title")
+        mode = st.selectbox("Lesson type", ["chapter", "story"], key=f"{key_prefix}_mode")
+        original_text = st.text_area(
+            "Paste your chapter or story",
+            height=220,
+            key=f"{key_prefix}_original",
+        )
+
+        use_ai = st.checkbox(
+            "Use AI to create a gentle version and illustration",
+            value=True,
+            key=f"{key_prefix}_ai",
+        )
+        generate = st.button("Generate with AI", key=f"{key_prefix}_generate")
+
+    with colB:
+        selected_names = st.multiselect(
+            copy["assign_label"],
+            options=list(audience_map.keys()),
+            key=f"{key_prefix}_assign_to",
+        )
+
+    # Generated text goes straight into the preview box's widget state; a
+    # keyed text_area ignores value= after its first render.
+    friendly_key = f"{key_prefix}_friendly_box"
+    image_key = f"{key_prefix}_image_path"
+    final_key = f"{key_prefix}_image_final"
+    image_path = st.session_state.get(image_key, "")
+
+    if generate and original_text:
+        old_image_path = image_path
+        if use_ai:
+            with st.spinner("Asking AI to create a gentle version and illustration..."):
+                friendly_text, image_path = generate_lesson_with_ai(title, original_text, mode=mode)
+        else:
+            friendly_text = "\n\n".join(
+                [f"Step {i+1}: {s}" for i, s in enumerate(split_into_steps(original_text, 2))]
+            )
+            image_path = ""
+
+        st.session_state[friendly_key] = friendly_text
+        st.session_state[image_key] = image_path
+        st.session_state[final_key] = False
+        if old_image_path != image_path:
+            discard_lesson_image(old_image_path)
+
+    st.markdown("### Friendly lesson preview")
+    friendly_text = st.text_area(
+        "You can edit this before sending:",
+        height=260,
+        key=friendly_key,
+    )
+
+    if image_path:
+        st.markdown("### Illustration preview")
+        display_lesson_image(image_path, caption="AI-generated illustration")
+        # The preview is a quick sketch. The lesson saves exactly the image
+        # shown here, so the full-quality one is drawn on request, not on save.
+        if not st.session_state.get(final_key):
+            if st.button("🎨 Draw full-quality illustration", key=f"{key_prefix}_final_image"):
+                with st.spinner("Drawing the full-quality illustration..."):
+                    final_path = generate_lesson_image(title or "Lesson", original_text, final=True)
+                if final_path:
+                    st.session_state[image_key] = final_path
+                    st.session_state[final_key] = True
+                    if final_path != image_path:
+                        discard_lesson_image(image_path)
+                    st.rerun()
+
+    if st.button(copy["save_label"], key=f"{key_prefix}_save"):
+        if not title or not original_text or not friendly_text:
+            st.error(copy["missing_msg"])
+        else:
+            with write_transaction() as conn:
+                cur = conn.cursor()
+                cur.execute(SQL_INSERT_LESSON, (
+                    owner_id, owner_role, title, original_text,
+                    friendly_text, image_path, len(lesson_steps(friendly_text)),
+                    utc_now_iso()
+                ))
+                lesson_id = cur.lastrowid
+
+                rows = [(lesson_id, audience_map[name], "assigned", 0, None) for name in selected_names]
+                cur.executemany(SQL_INSERT_ASSIGNMENT, rows)
+            st.success(copy["saved_msg"])
+
 # -------------------- TEACHER DASHBOARD --------------------
 def teacher_dashboard(user):
     st.title(f"👩‍🏫 Welcome, {user['name']}")
@@ -358,17 +975,14 @@ def teacher_dashboard(user):
                         st.caption(r["email"])
                     with col3:
                         if st.button("Add", key=f"add_learner_{r['id']}"):
-                            cur = conn.cursor()
-                            cur.execute("""
-                            INSERT INTO teacher_learners (teacher_id, learner_id)
-                            VALUES (?, ?)
-                            """, (user["id"], r["id"]))
-                            conn.commit()
+                            with write_transaction() as conn:
+                                conn.execute(SQL_ADD_TEACHER_LEARNER, (user["id"], r["id"]))
+                            get_user_bundle.clear()
                             st.success(f"Added {r['name']} as your learner.")
 
         st.markdown("---")
         st.subheader("Your current learners")
-        my_learners = get_teacher_learners(user["id"])
+        my_learners = get_linked_users(user["id"])
         if not my_learners:
             st.info("No learners added yet.")
         else:
@@ -379,124 +993,38 @@ def teacher_dashboard(user):
     with tab_lessons:
         st.subheader("Create a calm, step-by-step lesson")
 
-        colA, colB = st.columns([2, 1])
-        with colA:
-            title = st.text_input("Lesson title")
-            mode = st.selectbox("Lesson type", ["chapter", "story"])
-            original_text = st.text_area(
-                "Paste your chapter or story",
-                height=220,
-            )
-
-            use_ai = st.checkbox("Use AI to create a gentle version and illustration", value=True)
-            generate = st.button("Generate with AI")
-
-        with colB:
-            learners = get_teacher_learners(user["id"])
-            learner_map = {f"{l['name']} ({l['email']})": l["id"] for l in learners}
-            selected_names = st.multiselect(
-                "Assign to learners",
-                options=list(learner_map.keys()),
-            )
-
-        friendly_text = st.session_state.get("friendly_text_teacher", "")
-        image_b64 = st.session_state.get("image_b64_teacher", "")
-
-        if generate and original_text:
-            if use_ai:
-                with st.spinner("Asking AI to create a gentle version..."):
-                    friendly_text = generate_friendly_text_with_openai(original_text, mode=mode)
-                with st.spinner("Asking AI to draw an illustration..."):
-                    image_b64 = generate_lesson_image_b64(title or "Lesson", original_text)
-            else:
-                friendly_text = "\n\n".join(
-                    [f"Step {i+1}: {s}" for i, s in enumerate(split_into_steps(original_text, 2))]
-                )
-                image_b64 = ""
-
-            st.session_state.friendly_text_teacher = friendly_text
-            st.session_state.image_b64_teacher = image_b64
-
-        st.markdown("### Friendly lesson preview")
-        friendly_text = st.text_area(
-            "You can edit this before sending:",
-            value=friendly_text,
-            height=260,
-        )
-
-        if image_b64:
-            st.markdown("### Illustration preview")
-            display_b64_image(image_b64, caption="AI-generated illustration")
-
-        if st.button("Save & assign lesson"):
-            if not title or not original_text or not friendly_text:
-                st.error("Please provide title, text, and generated lesson.")
-            else:
-                cur = conn.cursor()
-                cur.execute("""
-                INSERT INTO lessons (owner_id, owner_role, title, original_text, friendly_text, image_b64, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    user["id"], "teacher", title, original_text,
-                    friendly_text, image_b64,
-                    datetime.datetime.utcnow().isoformat()
-                ))
-                lesson_id = cur.lastrowid
-
-                for name in selected_names:
-                    learner_id = learner_map[name]
-                    cur.execute("""
-                    INSERT INTO lesson_assignments (lesson_id, learner_id, status, progress_step, completed_at)
-                    VALUES (?, ?, 'assigned', 0, NULL)
-                    """, (lesson_id, learner_id))
-                conn.commit()
-                st.success("Lesson created and assigned!")
+        learners = get_linked_users(user["id"])
+        learner_map = {f"{l['name']} ({l['email']})": l["id"] for l in learners}
+        render_create_lesson("teacher", user["id"], learner_map, key_prefix="teacher")
 
     # ---- Lesson progress ----
     with tab_progress:
         st.subheader("Learner progress")
 
-        my_learners = get_teacher_learners(user["id"])
+        my_learners = get_linked_users(user["id"])
         if not my_learners:
             st.info("No learners yet.")
         else:
             learner_ids = tuple(l["id"] for l in my_learners)
-            placeholder = ",".join("?" * len(learner_ids))
-            cur = conn.cursor()
-            cur.execute(f"""
-            SELECT la.*, l.title, u.name as learner_name
-            FROM lesson_assignments la
-            JOIN lessons l ON la.lesson_id = l.id
-            JOIN users u ON la.learner_id = u.id
-            WHERE la.learner_id IN ({placeholder})
-            ORDER BY la.id DESC
-            """, learner_ids)
-            rows = cur.fetchall()
+            rows, has_more = get_lesson_progress(learner_ids, page_offset("teacher_progress_page"))
             if not rows:
-                st.info("No lessons assigned yet.")
+                st.info(empty_page_message("teacher_progress_page", "No lessons assigned yet."))
             else:
                 for r in rows:
                     st.markdown(
                         f"- **{r['learner_name']}** – {r['title']} – "
                         f"Status: `{r['status']}` – Step: {r['progress_step']}"
                     )
+            page_picker("teacher_progress_page", has_more)
 
     # ---- Help requests ----
     with tab_help:
         st.subheader("Help requests from learners")
 
-        cur = conn.cursor()
-        cur.execute("""
-        SELECT hr.*, u.name as learner_name
-        FROM help_requests hr
-        JOIN users u ON hr.learner_id = u.id
-        WHERE hr.to_user_id = ?
-        ORDER BY hr.created_at DESC
-        """, (user["id"],))
-        rows = cur.fetchall()
+        rows, has_more = get_help_requests(user["id"], page_offset("teacher_help_page"))
 
         if not rows:
-            st.info("No help requests right now.")
+            st.info(empty_page_message("teacher_help_page", "No help requests right now."))
         else:
             for r in rows:
                 col1, col2 = st.columns([4, 1])
@@ -509,15 +1037,12 @@ def teacher_dashboard(user):
                 with col2:
                     if not r["resolved"]:
                         if st.button("Mark resolved", key=f"resolve_{r['id']}"):
-                            cur2 = conn.cursor()
-                            cur2.execute(
-                                "UPDATE help_requests SET resolved = 1 WHERE id = ?",
-                                (r["id"],)
-                            )
-                            conn.commit()
+                            with write_transaction() as conn:
+                                conn.execute(SQL_RESOLVE_HELP_REQUEST, (r["id"],))
                             st.rerun()
                     else:
                         st.success("Resolved")
+        page_picker("teacher_help_page", has_more)
 
 # -------------------- PARENT DASHBOARD --------------------
 def parent_dashboard(user):
@@ -545,18 +1070,15 @@ def parent_dashboard(user):
                         st.caption(r["email"])
                     with col3:
                         if st.button("Add as my child", key=f"add_child_{r['id']}"):
-                            cur = conn.cursor()
-                            cur.execute("""
-                            INSERT INTO parent_children (parent_id, learner_id)
-                            VALUES (?, ?)
-                            """, (user["id"], r["id"]))
-                            conn.commit()
+                            with write_transaction() as conn:
+                                conn.execute(SQL_ADD_PARENT_CHILD, (user["id"], r["id"]))
+                            get_user_bundle.clear()
                             st.success(f"Linked {r['name']} as your child.")
 
         st.markdown("---")
         st.subheader("Children linked to your account")
 
-        kids = get_parent_children(user["id"])
+        kids = get_linked_users(user["id"])
         if not kids:
             st.info("No child accounts linked yet.")
         else:
@@ -567,128 +1089,38 @@ def parent_dashboard(user):
     with tab_lessons:
         st.subheader("Create a gentle lesson for your child")
 
-        kids = get_parent_children(user["id"])
+        kids = get_linked_users(user["id"])
         kid_map = {f"{k['name']} ({k['email']})": k["id"] for k in kids}
-
-        colA, colB = st.columns([2, 1])
-        with colA:
-            title = st.text_input("Lesson title", key="parent_title")
-            mode = st.selectbox("Lesson type", ["chapter", "story"], key="parent_mode")
-            original_text = st.text_area(
-                "Paste your chapter or story",
-                height=220,
-                key="parent_original",
-            )
-
-            use_ai = st.checkbox("Use AI to create a gentle version and illustration", value=True, key="parent_ai")
-            generate = st.button("Generate with AI", key="parent_generate")
-
-        with colB:
-            selected_names = st.multiselect(
-                "Send to:",
-                options=list(kid_map.keys()),
-                key="parent_assign_to",
-            )
-
-        friendly_text = st.session_state.get("parent_friendly_text", "")
-        image_b64 = st.session_state.get("parent_image_b64", "")
-
-        if generate and original_text:
-            if use_ai:
-                with st.spinner("Asking AI to create a gentle version..."):
-                    friendly_text = generate_friendly_text_with_openai(original_text, mode=mode)
-                with st.spinner("Asking AI to draw an illustration..."):
-                    image_b64 = generate_lesson_image_b64(title or "Lesson", original_text)
-            else:
-                friendly_text = "\n\n".join(
-                    [f"Step {i+1}: {s}" for i, s in enumerate(split_into_steps(original_text, 2))]
-                )
-                image_b64 = ""
-
-            st.session_state.parent_friendly_text = friendly_text
-            st.session_state.parent_image_b64 = image_b64
-
-        st.markdown("### Friendly lesson preview")
-        friendly_text = st.text_area(
-            "You can edit this before sending:",
-            value=friendly_text,
-            height=260,
-            key="parent_friendly_box",
-        )
-
-        if image_b64:
-            st.markdown("### Illustration preview")
-            display_b64_image(image_b64, caption="AI-generated illustration")
-
-        if st.button("Save & send"):
-            if not title or not original_text or not friendly_text:
-                st.error("Please fill all fields.")
-            else:
-                cur = conn.cursor()
-                cur.execute("""
-                INSERT INTO lessons (owner_id, owner_role, title, original_text, friendly_text, image_b64, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    user["id"], "parent", title, original_text,
-                    friendly_text, image_b64,
-                    datetime.datetime.utcnow().isoformat()
-                ))
-                lesson_id = cur.lastrowid
-
-                for name in selected_names:
-                    learner_id = kid_map[name]
-                    cur.execute("""
-                    INSERT INTO lesson_assignments (lesson_id, learner_id, status, progress_step, completed_at)
-                    VALUES (?, ?, 'assigned', 0, NULL)
-                    """, (lesson_id, learner_id))
-                conn.commit()
-                st.success("Lesson created and sent!")
+        render_create_lesson("parent", user["id"], kid_map, key_prefix="parent")
 
     # ---- Lesson progress ----
     with tab_progress:
         st.subheader("Lesson progress for your kids")
 
-        kids = get_parent_children(user["id"])
+        kids = get_linked_users(user["id"])
         if not kids:
             st.info("No children linked yet.")
         else:
             learner_ids = tuple(k["id"] for k in kids)
-            placeholder = ",".join("?" * len(learner_ids))
-            cur = conn.cursor()
-            cur.execute(f"""
-            SELECT la.*, l.title, u.name as learner_name
-            FROM lesson_assignments la
-            JOIN lessons l ON la.lesson_id = l.id
-            JOIN users u ON la.learner_id = u.id
-            WHERE la.learner_id IN ({placeholder})
-            ORDER BY la.id DESC
-            """, learner_ids)
-            rows = cur.fetchall()
+            rows, has_more = get_lesson_progress(learner_ids, page_offset("parent_progress_page"))
             if not rows:
-                st.info("No lessons yet.")
+                st.info(empty_page_message("parent_progress_page", "No lessons yet."))
             else:
                 for r in rows:
                     st.markdown(
                         f"- **{r['learner_name']}** – {r['title']} – "
                         f"Status: `{r['status']}` – Step: {r['progress_step']}"
                     )
+            page_picker("parent_progress_page", has_more)
 
     # ---- Help requests ----
     with tab_help:
         st.subheader("Help requests from your children")
 
-        cur = conn.cursor()
-        cur.execute("""
-        SELECT hr.*, u.name as learner_name
-        FROM help_requests hr
-        JOIN users u ON hr.learner_id = u.id
-        WHERE hr.to_user_id = ?
-        ORDER BY hr.created_at DESC
-        """, (user["id"],))
-        rows = cur.fetchall()
+        rows, has_more = get_help_requests(user["id"], page_offset("parent_help_page"))
 
         if not rows:
-            st.info("No help requests at the moment.")
+            st.info(empty_page_message("parent_help_page", "No help requests at the moment."))
         else:
             for r in rows:
                 col1, col2 = st.columns([4, 1])
@@ -701,17 +1133,29 @@ def parent_dashboard(user):
                 with col2:
                     if not r["resolved"]:
                         if st.button("Mark resolved", key=f"parent_resolve_{r['id']}"):
-                            cur2 = conn.cursor()
-                            cur2.execute(
-                                "UPDATE help_requests SET resolved = 1 WHERE id = ?",
-                                (r["id"],)
-                            )
-                            conn.commit()
+                            with write_transaction() as conn:
+                                conn.execute(SQL_RESOLVE_HELP_REQUEST, (r["id"],))
                             st.rerun()
                     else:
                         st.success("Resolved")
+        page_picker("parent_help_page", has_more)
 
 # -------------------- LEARNER DASHBOARD --------------------
+# Back/Next only move the step in session state. Positions are written to
+# the DB together on "Save my place", "I finished" or logging out, instead
+# of one commit per click. Positions not yet written are lost if the
+# browser session ends (refresh, closed tab) before one of those.
+def pending_progress() -> dict:
+    return st.session_state.setdefault("pending_progress", {})
+
+def flush_progress():
+    pending = st.session_state.get("pending_progress")
+    if not pending:
+        return
+    with write_transaction() as conn:
+        conn.executemany(SQL_UPDATE_PROGRESS_STEP, [(step, aid) for aid, step in pending.items()])
+    pending.clear()
+
 def learner_dashboard(user):
     st.title(f"🌈 Hi {user['name']}!")
 
@@ -726,22 +1170,26 @@ def learner_dashboard(user):
 
     # ---- My lessons ----
     with tabs[0]:
-        assignments = get_assigned_lessons(user["id"])
+        assignments, has_more = list_assigned_lessons(user["id"], page_offset("learner_lessons_page"))
         if not assignments:
-            st.info("No lessons yet. A teacher or parent can send one to you.")
+            st.info(empty_page_message(
+                "learner_lessons_page", "No lessons yet. A teacher or parent can send one to you."
+            ))
         else:
+            pending = pending_progress()
             for a in assignments:
                 with st.expander(f"{a['title']} – from {a['owner_name']} (status: {a['status']})"):
-                    steps = [s for s in a["friendly_text"].split("\n") if s.strip()]
-                    total_steps = len(steps)
-                    current_step = a["progress_step"]
+                    body = load_lesson_body(a["lesson_id"])
+                    steps = body["steps"]
+                    total_steps = a["total_steps"] or len(steps)
+                    current_step = pending.get(a["id"], a["progress_step"])
                     if current_step < 0:
                         current_step = 0
                     if current_step >= total_steps:
                         current_step = total_steps - 1
 
-                    if a["image_b64"]:
-                        display_b64_image(a["image_b64"], caption="Lesson picture")
+                    if body["image_path"]:
+                        display_lesson_image(body["image_path"], caption="Lesson picture")
 
                     st.progress((current_step + 1) / max(1, total_steps))
 
@@ -754,49 +1202,36 @@ def learner_dashboard(user):
                     col_prev, col_next = st.columns(2)
                     with col_prev:
                         if st.button("⬅️ Back", key=f"back_{a['id']}") and current_step > 0:
-                            new_step = current_step - 1
-                            cur = conn.cursor()
-                            cur.execute("""
-                            UPDATE lesson_assignments
-                            SET progress_step = ?
-                            WHERE id = ?
-                            """, (new_step, a["id"]))
-                            conn.commit()
+                            pending[a["id"]] = current_step - 1
                             st.rerun()
                     with col_next:
                         if st.button("Next ➡️", key=f"next_{a['id']}") and current_step < total_steps - 1:
-                            new_step = current_step + 1
-                            cur = conn.cursor()
-                            cur.execute("""
-                            UPDATE lesson_assignments
-                            SET progress_step = ?
-                            WHERE id = ?
-                            """, (new_step, a["id"]))
-                            conn.commit()
+                            pending[a["id"]] = current_step + 1
+                            st.rerun()
+
+                    if a["id"] in pending:
+                        if st.button("💾 Save my place", key=f"save_step_{a['id']}"):
+                            flush_progress()
                             st.rerun()
 
                     st.markdown("---")
                     if a["status"] != "completed":
                         if st.button("✅ I finished this lesson", key=f"finish_{a['id']}"):
-                            cur = conn.cursor()
-                            cur.execute("""
-                            UPDATE lesson_assignments
-                            SET status = 'completed',
-                                progress_step = ?,
-                                completed_at = ?
-                            WHERE id = ?
-                            """, (total_steps - 1, datetime.datetime.utcnow().isoformat(), a["id"]))
-                            conn.commit()
+                            with write_transaction() as conn:
+                                conn.execute(SQL_COMPLETE_ASSIGNMENT, (total_steps - 1, utc_now_iso(), a["id"]))
+                            pending.pop(a["id"], None)
+                            flush_progress()
                             st.success("Great job! Lesson marked as complete.")
                             st.rerun()
                     else:
                         st.success("Already marked as complete. Well done!")
+        page_picker("learner_lessons_page", has_more)
 
     # ---- Ask for help ----
     with tabs[1]:
         st.subheader("Ask a grown-up for help")
 
-        grownups = get_linked_grownups_for_learner(user["id"])
+        grownups = get_linked_users(user["id"])
         if not grownups:
             st.info("When a teacher or parent links their account to yours, "
                     "you'll be able to send them a message here.")
@@ -810,51 +1245,119 @@ def learner_dashboard(user):
                     st.error("Please write something in your message.")
                 else:
                     to_user_id = options[to_label]
-                    cur = conn.cursor()
-                    cur.execute("""
-                    INSERT INTO help_requests (learner_id, to_user_id, message, created_at, resolved)
-                    VALUES (?, ?, ?, ?, 0)
-                    """, (
-                        user["id"], to_user_id, message.strip(),
-                        datetime.datetime.utcnow().isoformat()
-                    ))
-                    conn.commit()
+                    with write_transaction() as conn:
+                        conn.execute(SQL_INSERT_HELP_REQUEST, (
+                            user["id"], to_user_id, message.strip(),
+                            utc_now_iso()
+                        ))
                     st.success("Your message has been sent.")
 
 # -------------------- MAIN APP --------------------
+# Dashboard per role; unknown roles get the learner view, as before.
+ROLE_DISPATCH = {
+    "teacher": teacher_dashboard,
+    "parent": parent_dashboard,
+    "learner": learner_dashboard,
+}
+
+# Widget changes inside the dashboard rerun only this fragment, not the
+# sidebar and auth checks in main(). Explicit st.rerun() calls after DB
+# writes still refresh the whole app.
+@st.fragment
+def dashboard_fragment(user):
+    ROLE_DISPATCH.get(user["role"], learner_dashboard)(user)
+
+# Fragments can't write to st.sidebar directly, so main() calls this
+# inside `with st.sidebar:`. Dashboard interactions then leave it alone.
+@st.fragment
+def account_sidebar():
+    # Name and role were stored at login; no lookup needed to show them.
+    auth = st.session_state["auth"]
+    st.markdown(f"**Logged in as:** {auth['name']} ({auth['role']})")
+    if st.button("Log out"):
+        flush_progress()
+        # A new nonce revokes every token issued so far, including copies
+        # of the URL left in history or shared; sessions already open with
+        # one drop out on their next run.
+        with write_transaction() as conn:
+            conn.execute(SQL_UPDATE_SESSION_NONCE, (new_session_nonce(), auth["id"]))
+        get_user_bundle.clear()
+        get_user_by_email.clear()
+        st.session_state.pop("auth", None)
+        st.query_params.pop("s", None)
+        st.rerun()
+
+# Typing, the sign-up role picker and failed submits rerun only the form.
+@st.fragment
+def auth_fragment(choice: str):
+    if choice == "Log in":
+        login_form()
+    else:
+        signup_form()
+
+def profile_run(fn):
+    """
+    Run fn under a profiler and show the report below the page. Uses
+    pyinstrument when it is installed, otherwise the stdlib cProfile.
+    """
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        Profiler = None
+
+    if Profiler is not None:
+        profiler = Profiler()
+        profiler.start()
+        try:
+            fn()
+        finally:
+            profiler.stop()
+            st.code(profiler.output_text(unicode=True, color=False))
+        return
+
+    import cProfile
+    import io
+    import pstats
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(fn)
+    finally:
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(40)
+        st.code(out.getvalue())
+
 def main():
-    st.sidebar.title("Calm Learning Hub")
+    # Add ?profile=1 to the URL to see where each run spends its time. The
+    # report shows file paths and internals, so the server must opt in by
+    # setting ENABLE_PROFILER=1.
+    if os.environ.get("ENABLE_PROFILER") == "1" and st.query_params.get("profile"):
+        profile_run(_main_body)
+    else:
+        _main_body()
 
-    if "user_id" not in st.session_state:
-        st.session_state.user_id = None
-        st.session_state.user_role = None
-        st.session_state.user_name = None
+def _main_body():
+    st.sidebar.title("Calm Learning Hub")
 
-    if st.session_state.user_id is None:
-        choice = st.sidebar.radio("Welcome", ["Log in", "Sign up"])
-        if choice == "Log in":
-            login_form()
-        else:
-            signup_form()
+    user = restore_session()
+    if user is None:
+        # A stale session drops straight to the login form in this same run;
+        # its dead token leaves the URL so later runs don't look it up again.
+        st.session_state.pop("auth", None)
+        st.query_params.pop("s", None)
+        # The choice is mirrored in ?tab=signup so the sign-up page can be
+        # linked to and survives a browser refresh.
+        on_signup = st.query_params.get("tab") == "signup"
+        choice = st.sidebar.radio("Welcome", ["Log in", "Sign up"], index=int(on_signup), key="_tab")
+        if (choice == "Sign up") != on_signup:
+            if choice == "Sign up":
+                st.query_params["tab"] = "signup"
+            else:
+                st.query_params.pop("tab", None)
+        auth_fragment(choice)
     else:
-        user = get_user_by_id(st.session_state.user_id)
-        if user is None:
-            st.session_state.user_id = None
-            st.rerun()
-
-        st.sidebar.markdown(f"**Logged in as:** {user['name']} ({user['role']})")
-        if st.sidebar.button("Log out"):
-            st.session_state.user_id = None
-            st.session_state.user_role = None
-            st.session_state.user_name = None
-            st.rerun()
-
-        if user["role"] == "teacher":
-            teacher_dashboard(user)
-        elif user["role"] == "parent":
-            parent_dashboard(user)
-        else:
-            learner_dashboard(user)
+        with st.sidebar:
+            account_sidebar()
+        dashboard_fragment(user)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file